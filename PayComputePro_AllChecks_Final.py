@@ -3,7 +3,6 @@ import pandas as pd
 import numpy as np
 from pathlib import Path
 from datetime import datetime
-from collections import defaultdict
 import io
 import json
 
@@ -17,7 +16,9 @@ MAX_MONTH = 12
 MIN_YEAR = 2020
 MAX_YEAR = 2050
 AMOUNT_WARNING_THRESHOLD = 10000
-AUDIT_LOG_FILE = "download_audit.json"
+AUDIT_LOG_FILE = "download_audit.jsonl"
+CSV_SYSTEM_HEADERS = ['currency-code', 'pay-date', 'pay-component-code', 'user-id', 'value', 'operation']
+CSV_DISPLAY_HEADERS = ['Currency', 'Issue Date', 'Pay Component', 'User ID', 'Spot Bonus Amount', 'Operation']
 
 # ============================================================================
 # PAGE CONFIG
@@ -69,6 +70,30 @@ st.markdown("""
 # QUALITY CONTROL CHECKS
 # ============================================================================
 
+def cell_text(values):
+    """str(cell).strip() for a whole Series; missing cells read as 'nan' on every pandas version"""
+    return values.astype(str).fillna('nan').str.strip()
+
+def scan_header_row(payroll_df, wage_mapping):
+    """Single pass over Row 1: mapped columns -> (code, component), plus unmapped codes"""
+    mapped_cols = {}
+    unmapped_codes = []
+    
+    for col_idx, header_val in enumerate(cell_text(payroll_df.iloc[0]).str.upper()):
+        if header_val == 'NAN' or header_val == '':
+            continue
+        
+        if header_val in wage_mapping:
+            mapped_cols[col_idx] = (header_val, wage_mapping[header_val])
+        elif header_val not in ['DEDUCTIONS', 'STAFF ID', 'ROW LABELS', 'STORE', 'DESIGNATION', 'GRAND TOTAL']:
+            unmapped_codes.append(header_val)
+    
+    return mapped_cols, unmapped_codes
+
+def get_amount_block(payroll_df, mapped_cols):
+    """Data rows x mapped columns as floats; non-numeric cells become NaN"""
+    return payroll_df.iloc[2:, list(mapped_cols)].apply(pd.to_numeric, errors='coerce').to_numpy(dtype=float)
+
 def check_1_file_structure_validation(payroll_df):
     """CHECK 1: File Structure Validation"""
     errors = []
@@ -95,54 +120,40 @@ def check_2_staff_id_validation(payroll_df):
     errors = []
     warnings = []
     
-    valid_ids = 0
-    invalid_ids = []
-    blank_ids = 0
+    ids = cell_text(payroll_df.iloc[2:, 0])
+    blank_mask = (ids == '') | (ids.str.lower() == 'nan')
+    short_mask = ~blank_mask & (ids.str.len() < 5)
     
-    for idx in range(2, len(payroll_df)):
-        emp_id = str(payroll_df.iloc[idx, 0]).strip()
-        
-        if not emp_id or emp_id.lower() == 'nan' or emp_id == '':
-            blank_ids += 1
-            invalid_ids.append(f"Row {idx+1}: Blank Staff ID")
-        elif len(emp_id) < 5:
-            invalid_ids.append(f"Row {idx+1}: ID '{emp_id}' seems too short")
-        else:
-            valid_ids += 1
+    valid_ids = int((~blank_mask & ~short_mask).sum())
+    blank_ids = int(blank_mask.sum())
+    short_ids = int(short_mask.sum())
     
-    total = valid_ids + blank_ids + len([x for x in invalid_ids if 'too short' in x])
+    invalid_ids = []
+    if blank_ids + short_ids <= 5:
+        invalid_mask = blank_mask | short_mask
+        for idx, emp_id, is_blank in zip(ids.index[invalid_mask], ids[invalid_mask], blank_mask[invalid_mask]):
+            if is_blank:
+                invalid_ids.append(f"Row {idx+1}: Blank Staff ID")
+            else:
+                invalid_ids.append(f"Row {idx+1}: ID '{emp_id}' seems too short")
+    
+    total = valid_ids + blank_ids + short_ids
     
     if total == 0:
         errors.append("❌ No valid rows found after header")
     elif blank_ids > 0:
         warnings.append(f"⚠️ Found {blank_ids} rows with blank Staff IDs")
     
-    if len(invalid_ids) > 0 and len(invalid_ids) <= 5:
-        for err in invalid_ids[:5]:
-            warnings.append(f"⚠️ {err}")
+    for err in invalid_ids:
+        warnings.append(f"⚠️ {err}")
     
     return errors, warnings, valid_ids, blank_ids
 
-def check_3_wage_code_validation(payroll_df, wage_mapping):
+def check_3_wage_code_validation(mapped_cols, unmapped_codes):
     """CHECK 3: Wage Code Validation"""
     errors = []
     warnings = []
     
-    headers = payroll_df.iloc[0]
-    unmapped_codes = []
-    mapped_codes = 0
-    
-    for col_idx in range(len(headers)):
-        header_val = str(headers.iloc[col_idx]).strip().upper()
-        
-        if pd.isna(header_val) or header_val == 'NAN' or header_val == '':
-            continue
-        
-        if header_val in wage_mapping:
-            mapped_codes += 1
-        elif header_val not in ['DEDUCTIONS', 'STAFF ID', 'ROW LABELS', 'STORE', 'DESIGNATION', 'GRAND TOTAL']:
-            unmapped_codes.append(header_val)
-    
     if unmapped_codes:
         if len(unmapped_codes) <= 5:
             for code in unmapped_codes:
@@ -152,45 +163,40 @@ def check_3_wage_code_validation(payroll_df, wage_mapping):
             for code in unmapped_codes[:5]:
                 warnings.append(f"   - '{code}'")
     
-    return errors, warnings, mapped_codes, len(unmapped_codes)
+    return errors, warnings, len(mapped_cols), len(unmapped_codes)
 
-def check_4_amount_range_validation(payroll_df, wage_mapping):
+def check_4_amount_range_validation(payroll_df, mapped_cols, amount_block):
     """CHECK 4: Amount Range Validation"""
     errors = []
     warnings = []
     
-    headers = payroll_df.iloc[0]
-    suspicious_amounts = []
-    negative_amounts = []
-    
-    for col_idx in range(len(headers)):
-        header_val = str(headers.iloc[col_idx]).strip().upper()
-        if header_val not in wage_mapping:
-            continue
-        
-        for row_idx in range(2, len(payroll_df)):
-            try:
-                amount = float(payroll_df.iloc[row_idx, col_idx])
-                
-                if amount < 0:
-                    emp_id = str(payroll_df.iloc[row_idx, 0])
-                    negative_amounts.append(f"Row {row_idx+1}, Emp {emp_id}: Negative amount {amount}")
-                elif amount > AMOUNT_WARNING_THRESHOLD:
-                    emp_id = str(payroll_df.iloc[row_idx, 0])
-                    suspicious_amounts.append(f"Row {row_idx+1}, Emp {emp_id}: High amount {amount:.2f}")
-            except:
-                pass
-    
-    if negative_amounts:
-        errors.extend([f"❌ {x}" for x in negative_amounts[:3]])
-        if len(negative_amounts) > 3:
-            errors.append(f"❌ ... and {len(negative_amounts)-3} more negative amounts")
-    
-    if suspicious_amounts:
-        for amt in suspicious_amounts[:3]:
-            warnings.append(f"⚠️ Unusual: {amt} AED (> {AMOUNT_WARNING_THRESHOLD})")
-        if len(suspicious_amounts) > 3:
-            warnings.append(f"⚠️ ... and {len(suspicious_amounts)-3} more high amounts")
+    # Transposed so offenders come out column by column, as they always have
+    block = amount_block.T
+    raw = payroll_df.iloc[2:, list(mapped_cols)].to_numpy().T
+    emp_ids = payroll_df.iloc[2:, 0].to_numpy()
+    
+    negative_idx = np.argwhere(block < 0)
+    suspicious_idx = np.argwhere(block > AMOUNT_WARNING_THRESHOLD)
+    # Filled cells that pd.to_numeric could not read are dropped from the upload
+    unreadable_idx = np.argwhere(np.isnan(block) & pd.notna(raw))
+    
+    if len(negative_idx):
+        for col, row in negative_idx[:3]:
+            errors.append(f"❌ Row {row+3}, Emp {emp_ids[row]}: Negative amount {block[col, row]}")
+        if len(negative_idx) > 3:
+            errors.append(f"❌ ... and {len(negative_idx)-3} more negative amounts")
+    
+    if len(suspicious_idx):
+        for col, row in suspicious_idx[:3]:
+            warnings.append(f"⚠️ Unusual: Row {row+3}, Emp {emp_ids[row]}: High amount {block[col, row]:.2f} AED (> {AMOUNT_WARNING_THRESHOLD})")
+        if len(suspicious_idx) > 3:
+            warnings.append(f"⚠️ ... and {len(suspicious_idx)-3} more high amounts")
+    
+    if len(unreadable_idx):
+        for col, row in unreadable_idx[:3]:
+            warnings.append(f"⚠️ Row {row+3}, Emp {emp_ids[row]}: Non-numeric amount '{raw[col, row]}' skipped")
+        if len(unreadable_idx) > 3:
+            warnings.append(f"⚠️ ... and {len(unreadable_idx)-3} more non-numeric amounts")
     
     return errors, warnings
 
@@ -198,46 +204,40 @@ def check_6_data_quality_report(deductions):
     """CHECK 6: Data Quality Report"""
     report = {}
     
-    if not deductions:
+    if deductions.empty:
         return report
     
-    unique_employees = len(set(d['emp_id'] for d in deductions))
-    unique_components = len(set(d['component'] for d in deductions))
-    total_amount = sum(d['amount'] for d in deductions)
-    avg_amount = total_amount / len(deductions) if deductions else 0
+    amount_stats = deductions['amount'].agg(['sum', 'mean', 'min', 'max'])
     
     report['total_records'] = len(deductions)
-    report['unique_employees'] = unique_employees
-    report['unique_components'] = unique_components
-    report['total_amount'] = total_amount
-    report['avg_amount'] = avg_amount
-    report['min_amount'] = min(d['amount'] for d in deductions) if deductions else 0
-    report['max_amount'] = max(d['amount'] for d in deductions) if deductions else 0
+    report['unique_employees'] = deductions['emp_id'].nunique()
+    report['unique_components'] = deductions['component'].nunique()
+    report['total_amount'] = float(amount_stats['sum'])
+    report['avg_amount'] = float(amount_stats['mean'])
+    report['min_amount'] = float(amount_stats['min'])
+    report['max_amount'] = float(amount_stats['max'])
     
     return report
 
-def check_7_missing_blank_cells(payroll_df, wage_mapping):
+def check_7_missing_blank_cells(payroll_df, mapped_cols):
     """CHECK 7: Missing/Blank Cell Detection"""
     warnings = []
     
-    headers = payroll_df.iloc[0]
-    blank_cell_rows = []
+    if not mapped_cols:
+        return warnings
     
-    for col_idx in range(len(headers)):
-        header_val = str(headers.iloc[col_idx]).strip().upper()
-        if header_val not in wage_mapping:
-            continue
-        
-        for row_idx in range(2, len(payroll_df)):
-            cell_value = payroll_df.iloc[row_idx, col_idx]
-            if pd.isna(cell_value) or str(cell_value).strip() == '':
-                emp_id = str(payroll_df.iloc[row_idx, 0])
-                blank_cell_rows.append(f"Row {row_idx+1}, Emp {emp_id}: Blank cell")
+    sub = payroll_df.iloc[2:, list(mapped_cols)]
+    
+    # Transposed so blanks are reported column by column
+    blank_mask = (sub.isna().to_numpy() | (np.char.strip(sub.to_numpy(dtype=str)) == '')).T
+    blank_idx = np.argwhere(blank_mask)
+    emp_ids = payroll_df.iloc[2:, 0].to_numpy()
     
-    if blank_cell_rows:
-        warnings.extend([f"⚠️ {x}" for x in blank_cell_rows[:3]])
-        if len(blank_cell_rows) > 3:
-            warnings.append(f"⚠️ ... and {len(blank_cell_rows)-3} more blank cells")
+    if len(blank_idx):
+        for col, row in blank_idx[:3]:
+            warnings.append(f"⚠️ Row {row+3}, Emp {emp_ids[row]}: Blank cell")
+        if len(blank_idx) > 3:
+            warnings.append(f"⚠️ ... and {len(blank_idx)-3} more blank cells")
     
     return warnings
 
@@ -246,50 +246,29 @@ def check_8_component_consistency(deductions):
     warnings = []
     
     # Check for case inconsistencies
-    components = {}
-    for ded in deductions:
-        component_upper = ded['component'].upper()
-        if component_upper not in components:
-            components[component_upper] = ded['component']
-        elif components[component_upper] != ded['component']:
-            warnings.append(f"⚠️ Component case inconsistency: '{components[component_upper]}' vs '{ded['component']}'")
+    spellings = deductions.groupby(deductions['component'].str.upper(), sort=False)['component'].unique()
+    
+    for variants in spellings:
+        if len(variants) > 1:
+            warnings.append("⚠️ Component case inconsistency: " + " vs ".join(f"'{v}'" for v in variants))
     
     return warnings
 
-def check_9_pre_download_validation(csv_content):
+def check_9_pre_download_validation(deductions):
     """CHECK 9: Pre-Download Validation"""
     errors = []
     warnings = []
     
-    lines = csv_content.strip().split('\n')
-    
-    # Check Row 1: System headers
-    expected_row1 = 'currency-code,pay-date,pay-component-code,user-id,value,operation'
-    if lines[0] != expected_row1:
-        errors.append("❌ Row 1: System headers incorrect")
-    
-    # Check Row 2: Display headers
-    expected_row2 = 'Currency,Issue Date,Pay Component,User ID,Spot Bonus Amount,Operation'
-    if lines[1] != expected_row2:
-        errors.append("❌ Row 2: Display headers incorrect")
-    
-    # Check for zero amounts in data
-    zero_count = 0
-    for line in lines[2:]:
-        if line.strip():
-            parts = line.split(',')
-            if len(parts) > 4:
-                try:
-                    if float(parts[4]) == 0:
-                        zero_count += 1
-                except:
-                    pass
+    # Headers come from CSV_SYSTEM_HEADERS / CSV_DISPLAY_HEADERS, so only the records need checking
+    records = deductions[deductions['amount'] > 0]
     
+    # Check for amounts that would be written as 0.00, using the generator's '%.2f' formatting
+    zero_count = int((records['amount'].map('{:.2f}'.format) == '0.00').sum())
     if zero_count > 0:
         errors.append(f"❌ Found {zero_count} records with 0 amount (should be filtered)")
     
     # Check file structure
-    if len(lines) < 3:
+    if records.empty:
         errors.append("❌ CSV has less than 3 rows (need headers + data)")
     
     return errors, warnings
@@ -304,17 +283,10 @@ def check_10_audit_log(sheet_name, record_count, total_amount):
         'filename': f"{sheet_name}.csv"
     }
     
+    # JSON Lines: one entry per line, appended without rewriting the log
     try:
-        if Path(AUDIT_LOG_FILE).exists():
-            with open(AUDIT_LOG_FILE, 'r') as f:
-                audit_log = json.load(f)
-        else:
-            audit_log = []
-        
-        audit_log.append(audit_entry)
-        
-        with open(AUDIT_LOG_FILE, 'w') as f:
-            json.dump(audit_log, f, indent=2)
+        with open(AUDIT_LOG_FILE, 'a') as f:
+            f.write(json.dumps(audit_entry) + '\n')
     except:
         pass
     
@@ -334,66 +306,52 @@ def get_days_in_month(month, year):
 
 def load_wage_mapping(mapping_file):
     try:
-        df = pd.read_excel(mapping_file, sheet_name=0, header=None)
-        mapping = {}
-        for idx, row in df.iterrows():
-            if pd.notna(row[0]) and pd.notna(row[1]):
-                code = str(row[0]).strip().upper()
-                component = str(row[1]).strip()
-                if code not in ['RAMCO CODE', 'NOT AVAILABLE'] and component not in ['SAP PAYCOMPONENT', 'NOT AVAILABLE']:
-                    mapping[code] = component
-        return mapping
+        df = pd.read_excel(mapping_file, sheet_name=0, header=None, usecols=[0, 1], engine='calamine').dropna()
+        codes = df[0].astype(str).str.strip().str.upper()
+        components = df[1].astype(str).str.strip()
+        keep = ~codes.isin(['RAMCO CODE', 'NOT AVAILABLE']) & ~components.isin(['SAP PAYCOMPONENT', 'NOT AVAILABLE'])
+        return dict(zip(codes[keep], components[keep]))
     except Exception as e:
         st.error(f"Error loading wage mapping: {str(e)}")
         return None
 
-def extract_deductions_row1(payroll_df, wage_mapping):
-    deductions = []
-    
+@st.cache_data(show_spinner=False)
+def load_wage_mapping_cached(mapping_path, mtime):
+    """Parse the mapping once per file version; mtime is only part of the cache key"""
+    return load_wage_mapping(mapping_path)
+
+@st.cache_data(show_spinner=False, max_entries=8, ttl=3600)
+def load_payroll_file(file_bytes):
+    """Parse an uploaded payroll workbook once per distinct file content; kept briefly as it holds staff data"""
+    return pd.read_excel(io.BytesIO(file_bytes), sheet_name=0, header=None, engine='calamine')
+
+def extract_deductions_row1(payroll_df, mapped_cols, amount_block):
     try:
-        headers = payroll_df.iloc[0]
-        deduction_cols = {}
-        found_codes = []
+        if not mapped_cols:
+            return None, f"❌ No deduction codes found in Row 1."
         
-        for col_idx in range(len(headers)):
-            header_val = str(headers.iloc[col_idx]).strip().upper()
-            
-            if pd.isna(header_val) or header_val == 'NAN' or header_val == '':
-                continue
-            
-            if header_val in wage_mapping:
-                deduction_cols[col_idx] = (header_val, wage_mapping[header_val])
-                found_codes.append(header_val)
+        emp_ids = cell_text(payroll_df.iloc[2:, 0])
+        if payroll_df.shape[1] > 1:
+            emp_names = cell_text(payroll_df.iloc[2:, 1])
+        else:
+            emp_names = pd.Series("Unknown", index=emp_ids.index)
         
-        if not deduction_cols:
-            return None, f"❌ No deduction codes found in Row 1."
+        valid_rows = ((emp_ids != '') & (emp_ids.str.lower() != 'nan')).to_numpy()
         
-        for row_idx in range(2, len(payroll_df)):
-            row = payroll_df.iloc[row_idx]
-            
-            try:
-                emp_id = str(row.iloc[0]).strip()
-                emp_name = str(row.iloc[1]).strip() if len(row) > 1 else "Unknown"
-                
-                if not emp_id or emp_id.lower() == 'nan' or emp_id == '':
-                    continue
-                
-                for col_idx, (ramco_code, component) in deduction_cols.items():
-                    try:
-                        amount = float(row.iloc[col_idx]) if col_idx < len(row) else 0
-                        
-                        if pd.notna(amount) and amount > 0:
-                            deductions.append({
-                                'emp_id': emp_id,
-                                'emp_name': emp_name,
-                                'code': ramco_code,
-                                'component': component,
-                                'amount': amount
-                            })
-                    except (ValueError, TypeError):
-                        continue
-            except Exception as e:
-                continue
+        # Row-major nonzero keeps records grouped by employee, in sheet column order
+        rows, cols = np.nonzero((amount_block > 0) & valid_rows[:, None])
+        codes, components = zip(*mapped_cols.values())
+        
+        deductions = pd.DataFrame({
+            'emp_id': emp_ids.to_numpy()[rows],
+            'emp_name': emp_names.to_numpy()[rows],
+            'code': np.array(codes, dtype=object)[cols],
+            'component': np.array(components, dtype=object)[cols],
+            'amount': amount_block[rows, cols]
+        })
+        
+        # Codes repeat across records; amounts stay float64 to keep cents exact
+        deductions = deductions.astype({'emp_id': 'string[pyarrow]', 'emp_name': 'string[pyarrow]', 'code': 'category', 'component': 'category'})
         
         return deductions, None
     
@@ -402,41 +360,23 @@ def extract_deductions_row1(payroll_df, wage_mapping):
 
 def rotate_dates_descending(deductions, month, year):
     days_in_month = get_days_in_month(month, year)
-    date_tracker = defaultdict(int)
     
-    for deduction in deductions:
-        key = (deduction['emp_id'], deduction['component'])
-        day = days_in_month - date_tracker[key]
-        
-        if day < 1:
-            day = 1
-        
-        deduction['pay_date'] = f"{day:02d}/{month:02d}/{year}"
-        date_tracker[key] += 1
+    # Each repeat of an (employee, component) pair steps back one day, floored at the 1st
+    repeat = deductions.groupby(['emp_id', 'component'], sort=False, observed=True).cumcount().to_numpy()
+    day = np.clip(days_in_month - repeat, 1, None)
     
+    date_strs = np.array([f"{d:02d}/{month:02d}/{year}" for d in range(1, days_in_month + 1)], dtype=object)
+    deductions['pay_date'] = date_strs[day - 1]
     return deductions
 
 def generate_csv_with_two_header_rows(deductions):
-    row1_headers = ['currency-code', 'pay-date', 'pay-component-code', 'user-id', 'value', 'operation']
-    row2_headers = ['Currency', 'Issue Date', 'Pay Component', 'User ID', 'Spot Bonus Amount', 'Operation']
-    
-    output = io.StringIO()
-    output.write(','.join(row1_headers) + '\n')
-    output.write(','.join(row2_headers) + '\n')
-    
-    for ded in deductions:
-        if ded['amount'] > 0:
-            row_data = [
-                CURRENCY,
-                ded['pay_date'],
-                str(ded['component']),
-                str(ded['emp_id']),
-                str(round(float(ded['amount']), 2)),
-                ''
-            ]
-            output.write(','.join(row_data) + '\n')
-    
-    return output.getvalue()
+    header = f"{','.join(CSV_SYSTEM_HEADERS)}\n{','.join(CSV_DISPLAY_HEADERS)}\n"
+    
+    records = deductions[deductions['amount'] > 0].assign(currency=CURRENCY, operation='')
+    records = records[['currency', 'pay_date', 'component', 'emp_id', 'amount', 'operation']]
+    body = records.to_csv(header=False, index=False, float_format='%.2f', lineterminator='\n')
+    
+    return header + body
 
 # ============================================================================
 # MAIN APP
@@ -513,8 +453,10 @@ else:
                 st.divider()
                 
                 # Load mapping
-                wage_mapping = load_wage_mapping(mapping_path)
-                payroll_df = pd.read_excel(uploaded_file, sheet_name=0, header=None)
+                mapping_mtime = mapping_path.stat().st_mtime
+                wage_mapping = load_wage_mapping_cached(str(mapping_path), mapping_mtime)
+                file_bytes = uploaded_file.getvalue()
+                payroll_df = load_payroll_file(file_bytes)
                 
                 # CHECK 1: File Structure
                 st.write("**CHECK 1:** File Structure Validation")
@@ -522,8 +464,15 @@ else:
                 if errors1:
                     for err in errors1:
                         st.markdown(f'<p class="check-failed">{err}</p>', unsafe_allow_html=True)
-                else:
-                    st.markdown('<p class="check-passed">✅ File structure valid</p>', unsafe_allow_html=True)
+                    # Later checks would only report noise on a malformed file. Reset the
+                    # flag first: the finally block cannot update session state once stopping.
+                    st.session_state.generate = False
+                    st.stop()
+                st.markdown('<p class="check-passed">✅ File structure valid</p>', unsafe_allow_html=True)
+                
+                # Resolve Row 1 codes and coerce their amounts once for all checks
+                mapped_cols, unmapped_codes = scan_header_row(payroll_df, wage_mapping)
+                amount_block = get_amount_block(payroll_df, mapped_cols)
                 
                 # CHECK 2: Staff ID Validation
                 st.write("**CHECK 2:** Staff ID Validation")
@@ -539,7 +488,7 @@ else:
                 
                 # CHECK 3: Wage Code Validation
                 st.write("**CHECK 3:** Wage Code Validation")
-                errors3, warn3, mapped, unmapped = check_3_wage_code_validation(payroll_df, wage_mapping)
+                errors3, warn3, mapped, unmapped = check_3_wage_code_validation(mapped_cols, unmapped_codes)
                 if errors3:
                     for err in errors3:
                         st.markdown(f'<p class="check-failed">{err}</p>', unsafe_allow_html=True)
@@ -551,32 +500,37 @@ else:
                 
                 # CHECK 4: Amount Range Validation
                 st.write("**CHECK 4:** Amount Range Validation")
-                errors4, warn4 = check_4_amount_range_validation(payroll_df, wage_mapping)
+                errors4, warn4 = check_4_amount_range_validation(payroll_df, mapped_cols, amount_block)
                 if errors4:
                     for err in errors4[:3]:
                         st.markdown(f'<p class="check-failed">{err}</p>', unsafe_allow_html=True)
                 else:
                     st.markdown('<p class="check-passed">✅ All amounts in valid range</p>', unsafe_allow_html=True)
                 if warn4:
-                    for w in warn4[:3]:
+                    for w in warn4:
                         st.markdown(f'<p class="check-warning">{w}</p>', unsafe_allow_html=True)
                 
                 st.divider()
                 st.write("📋 **PROCESSING DATA**")
                 
-                # Extract deductions
-                deductions, error = extract_deductions_row1(payroll_df, wage_mapping)
+                # Extract deductions, reusing the last result while file, mapping and period are unchanged
+                deductions_key = (hash(file_bytes), mapping_mtime, month, year)
+                if st.session_state.get("deductions_key") != deductions_key:
+                    deductions, error = extract_deductions_row1(payroll_df, mapped_cols, amount_block)
+                    if not error:
+                        # Apply date rotation
+                        deductions = rotate_dates_descending(deductions, month, year)
+                    st.session_state.deductions = (deductions, error)
+                    st.session_state.deductions_key = deductions_key
+                deductions, error = st.session_state.deductions
                 
                 if error:
                     st.error(f"{error}")
-                elif not deductions:
+                elif deductions.empty:
                     st.error("❌ No deductions found")
                 else:
                     st.write(f"✅ Extracted {len(deductions)} deduction records")
                     
-                    # Apply date rotation
-                    deductions = rotate_dates_descending(deductions, month, year)
-                    
                     # CHECK 6: Data Quality Report
                     st.write("**CHECK 6:** Data Quality Report")
                     report = check_6_data_quality_report(deductions)
@@ -595,7 +549,7 @@ else:
                     
                     # CHECK 7: Missing/Blank Cells
                     st.write("**CHECK 7:** Missing/Blank Cell Detection")
-                    warn7 = check_7_missing_blank_cells(payroll_df, wage_mapping)
+                    warn7 = check_7_missing_blank_cells(payroll_df, mapped_cols)
                     if warn7:
                         for w in warn7[:3]:
                             st.markdown(f'<p class="check-warning">{w}</p>', unsafe_allow_html=True)
@@ -614,12 +568,9 @@ else:
                     st.divider()
                     st.write("📋 **EXPORT & VALIDATION**")
                     
-                    # Generate CSV
-                    csv_data = generate_csv_with_two_header_rows(deductions)
-                    
                     # CHECK 9: Pre-Download Validation
                     st.write("**CHECK 9:** Pre-Download Validation")
-                    errors9, warn9 = check_9_pre_download_validation(csv_data)
+                    errors9, warn9 = check_9_pre_download_validation(deductions)
                     if errors9:
                         for err in errors9:
                             st.markdown(f'<p class="check-failed">{err}</p>', unsafe_allow_html=True)
@@ -629,9 +580,12 @@ else:
                         for w in warn9[:2]:
                             st.markdown(f'<p class="check-warning">{w}</p>', unsafe_allow_html=True)
                     
-                    if not errors9 and not errors1 and not errors2:
+                    if not errors9 and not errors2:
                         st.success("✅ **ALL CHECKS PASSED - READY TO DOWNLOAD!**")
                         
+                        # Generate CSV
+                        csv_data = generate_csv_with_two_header_rows(deductions)
+                        
                         st.divider()
                         
                         filename = f"{sheet_name}.csv"